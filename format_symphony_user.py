@@ -30,13 +30,14 @@ from __future__ import absolute_import, print_function
 
 import argparse
 import csv
+import heapq
+import locale
 import operator
 import os
-import platform
 import sys
 from configparser import ConfigParser
 from datetime import datetime
-from shutil import copyfile
+from shutil import copyfile, copyfileobj
 
 import pysftp
 
@@ -53,38 +54,182 @@ CSV_NAME = config.get("filenames", "csv_name")
 ASCII_NAME = config.get("filenames", "ascii_name")
 CSV_PATH = os.path.join(sys.path[0], CSV_NAME)
 ASCII_DIR = os.path.join(sys.path[0], "generated_ascii")
+ASCII_DIR_SEP = ASCII_DIR + os.sep
 ASCII_DEST = os.path.join(sys.path[0], ASCII_NAME)
 
-# Time stamp and generic I/O error message.
+# SFTP tuning. Connection options are read from config in connect_sftp.
+#
+# Seconds between SSH keepalive packets on an open SFTP connection.
+SFTP_KEEPALIVE = 30
+# Bytes read from the local file per remote write. Paramiko splits each
+# write into 32 KB requests and keeps all of them in flight when pipelined.
+SFTP_BLOCK_SIZE = 1024 * 1024
+
+# Required CSV columns, in the order they are unpacked from each row.
+CSV_COLUMNS = (
+    "student_id",
+    "first_name",
+    "last_name",
+    "birthdate",
+    "grade",
+    "grad_year",
+    "street",
+    "city",
+    "state",
+    "zip",
+    "email",
+    "phone_number",
+)
+
+# Static user data values, the same for every user record.
+ID_PREFIX = config.get("data", "id_prefix")
+USER_ROUTING_FLAG = config.get("data", "USER_ROUTING_FLAG")
+USER_NAME_DSP_PREF = config.get("data", "USER_NAME_DSP_PREF")
+USER_LIBRARY = config.get("data", "USER_LIBRARY")
+USER_PROFILE = config.get("data", "USER_PROFILE")
+USER_ACCESS = config.get("data", "USER_ACCESS")
+USER_ENVIRONMENT = config.get("data", "USER_ENVIRONMENT")
+USER_CATEGORY1 = config.get("data", "USER_CATEGORY1")
+USER_CATEGORY11 = config.get("data", "USER_CATEGORY11")
+USER_STATUS = config.get("data", "USER_STATUS")
+EXPIRE_DAY = config.get("data", "expire_day")
+NOTIFY_VIA = config.get("data", "NOTIFY_VIA")
+USER_CHG_HIST_RULE = config.get("data", "USER_CHG_HIST_RULE")
+
+# Names of the per user values built from each CSV row, in the order they're
+# passed to the generated emit_record.
+USER_VALUES = (
+    "user_id",
+    "first_name",
+    "last_name",
+    "birthdate",
+    "user_pin",
+    "grad_year",
+    "priv_expires",
+    "street",
+    "city_state",
+    "zip",
+    "phone",
+    "email",
+)
+
+# LDUSER record layout as (field, value, is_dynamic). Dynamic values are names
+# from USER_VALUES.
+RECORD_TEMPLATE = (
+    ("USER_ID", "user_id", True),
+    ("USER_ROUTING_FLAG", USER_ROUTING_FLAG, False),
+    ("USER_FIRST_NAME", "first_name", True),
+    ("USER_LAST_NAME", "last_name", True),
+    ("USER_NAME_DSP_PREF", USER_NAME_DSP_PREF, False),
+    ("USER_BIRTH_DATE", "birthdate", True),
+    ("USER_LIBRARY", USER_LIBRARY, False),
+    ("USER_PROFILE", USER_PROFILE, False),
+    ("USER_PIN", "user_pin", True),
+    ("USER_ACCESS", USER_ACCESS, False),
+    ("USER_ENVIRONMENT", USER_ENVIRONMENT, False),
+    ("USER_CATEGORY1", USER_CATEGORY1, False),
+    ("USER_CATEGORY11", USER_CATEGORY11, False),
+    ("USER_CATEGORY12", "grad_year", True),
+    ("USER_PRIV_EXPIRES", "priv_expires", True),
+    ("USER_STATUS", USER_STATUS, False),
+    ("USER_MAILINGADDR", "1", False),
+    ("USER_ADDR1_BEGIN", "", False),
+    ("STREET", "street", True),
+    ("CITY/STATE", "city_state", True),
+    ("ZIP", "zip", True),
+    ("PHONE", "phone", True),
+    ("EMAIL", "email", True),
+    ("USER_ADDR1_END", "", False),
+    ("USER_XINFO_BEGIN", "", False),
+    ("NOTIFY_VIA", NOTIFY_VIA, False),
+    ("USER_XINFO_END", "", False),
+    ("USER_CHG_HIST_RULE", USER_CHG_HIST_RULE, False),
+)
+
+# Time stamp, current year and generic I/O error message.
 TIMESTAMP = str(datetime.today().strftime("%Y%m%d-%H%M%S"))
+CURR_YEAR = datetime.today().year
 PERM_ERROR = "Failed to write to file. Check permissions. Exiting."
 
+# Output encoding. Same default that open() uses to read the CSV.
+ENCODING = locale.getpreferredencoding(False)
 
-def write_value(file, field, value):
-    """Write ASCII formatted value."""
+# Pre-encoded header starting each record and newline ending each line.
+RECORD_HEADER = b"*** DOCUMENT BOUNDARY ***\nFORM=LDUSER\n"
+NEWLINE = b"\n"
+
+# Suffixes of fields marking the start and end of a block. These take no value.
+MARKERS = ("_BEGIN", "_END")
+
+# Phone number translation. Drop "(" and change ")" and "-" to spaces.
+PHONE_TABLE = str.maketrans({"(": None, ")": " ", "-": " "})
+
+
+def format_value(field, value):
+    """Return ASCII formatted value as encoded bytes."""
     # Strip trailing whitespace. ASCII format hates trailing whitespace.
     value = value.rstrip()
-    try:
-        file.write("." + field + ".")
-        markers = ["_BEGIN", "_END"]
-        if any(x in field for x in markers):
-            file.write("\n")
+    if field.endswith(MARKERS):
+        line = f".{field}.\n"
+    else:
+        line = f".{field}.   |a{value}\n"
+    return line.encode(ENCODING)
+
+
+def encode_template(template):
+    """Pre-encode record template to (line, index) pairs. Static fields are
+    encoded whole with index None. Dynamic fields are encoded up to where their
+    value starts, with index of the per user value to follow."""
+    lines = []
+    for field, value, is_dynamic in template:
+        if is_dynamic:
+            lines.append((f".{field}.   |a".encode(ENCODING), USER_VALUES.index(value)))
         else:
-            file.write("   " + "|" + "a" + value + "\n")
-    except (IOError, OSError):
-        print(PERM_ERROR)
-        exit(1)
+            lines.append((format_value(field, value), None))
+    return tuple(lines)
+
+
+def compile_emitter(record_lines):
+    """Generate emit_record(buf, user_values) from pre-encoded record lines.
+    The function appends one LDUSER record to buffer from a tuple of per user
+    values ordered as USER_VALUES. Layout is fixed, so it's written out as
+    straight-line code with runs of constant bytes merged into one literal
+    instead of walking the template for every row."""
+    body = []
+    static = RECORD_HEADER
+    for line, index in record_lines:
+        static += line
+        if index is not None:
+            body.append("    buf += %r" % static)
+            # Strip trailing whitespace. ASCII format hates trailing whitespace.
+            body.append("    buf += user_values[%d].rstrip().encode(encoding)" % index)
+            static = NEWLINE
+    body.append("    buf += %r" % (static + NEWLINE))
+    source = "def emit_record(buf, user_values):\n" + "\n".join(body) + "\n"
+
+    namespace = {"encoding": ENCODING}
+    exec(compile(source, "<emit_record>", "exec"), namespace)
+    return namespace["emit_record"]
+
+
+def write_buffer(fd, buf):
+    """Write whole buffer to file descriptor. os.write may write only part of
+    a large buffer, so keep going until it's all written."""
+    view = memoryview(buf)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
 
 
 def transform_zip(number):
     """Get rid of extended format ZIP code."""
-    zip_code = number.split("-")[0]
+    zip_code = number.partition("-")[0]
     return zip_code
 
 
 def transform_phone(number):
     """Expected phone number format (555)555-5555. Changes to spaces only."""
-    phone = number.replace("(", "").replace(")", " ").replace("-", " ")
+    phone = number.translate(PHONE_TABLE)
     return phone
 
 
@@ -99,12 +244,8 @@ def get_grad_year(year, grade):
         grade = 0
 
     if year != "":
-        year = year
-    else:
-        curr_year = int(datetime.today().strftime("%Y"))
-        years_to_grad = 12 - int(grade)
-        year = years_to_grad + curr_year
-    return str(year)
+        return year
+    return str(12 - grade + CURR_YEAR)
 
 
 def copy_report(file):
@@ -113,46 +254,32 @@ def copy_report(file):
         copyfile(file, ASCII_DEST)
     except (IOError, OSError):
         print(PERM_ERROR)
-        exit(1)
-
-
-def creation_date(path_to_file):
-    """Try to get the date that a file was created, falling back to when
-    it was last modified if that isn't possible. See
-    http://stackoverflow.com/a/39501288/1709587 for explanation."""
-    if platform.system() == "Windows":
-        return os.path.getctime(path_to_file)
-    else:
-        stat = os.stat(path_to_file)
-        try:
-            return stat.st_birthtime
-        except AttributeError:
-            # We're probably on Linux. No easy way to get creation dates here,
-            # so we'll settle for when its content was last modified.
-            return stat.st_mtime
+        sys.exit(1)
 
 
 def report_dates(report_dir):
-    """Get dict of report files and created timestamp."""
+    """Get dict of report files and last modified timestamp. Reports are
+    never changed once written, so modification time is used for ordering."""
     report_dates = {}
-    for report in os.listdir(report_dir):
-        if report.endswith(".txt"):
-            date = int(creation_date(os.path.join(report_dir, report)))
-            report_dates[report] = date
+    with os.scandir(report_dir) as entries:
+        for report in entries:
+            if report.name.endswith(".txt"):
+                report_dates[report.name] = int(report.stat().st_mtime)
     return report_dates
 
 
-def upload_ftp_file(ascii_file):
-    """Connect to SirsiDynix SFTP server specified in config file and upload
-    converted ASCII formatted user data."""
-    # Define variables from config file.
+def connect_sftp():
+    """Connect to SirsiDynix SFTP server specified in config file. Returned
+    connection can be reused for several uploads and should be closed by the
+    caller."""
+    # Define variables from config file. Only needed when uploading, so a
+    # plain run works without a complete sftp section.
     server = config.get("sftp", "server")
-    port = (config.getint("sftp", "port"))
+    port = config.getint("sftp", "port")
     username = config.get("sftp", "user")
     password = config.get("sftp", "password")
-    known_hosts = config.get("sftp", "host_file")
-    known_hosts_file = os.path.join(CFG_DIR, known_hosts)
-    disable_key_check = (config.getboolean("sftp", "disable_key_check"))
+    known_hosts_file = os.path.join(CFG_DIR, config.get("sftp", "host_file"))
+    disable_key_check = config.getboolean("sftp", "disable_key_check")
 
     # Open connection. Set cnopts to verify host key. Set True to skip.
     cnopts = pysftp.CnOpts()
@@ -166,13 +293,29 @@ def upload_ftp_file(ascii_file):
     except Exception as e:
         err = str(e)
         print(err)
-        exit(1)
+        sys.exit(1)
+
+    # Keep connection alive between uploads.
+    srv.sftp_client.get_channel().get_transport().set_keepalive(SFTP_KEEPALIVE)
+    return srv
+
+
+def upload_ftp_file(sftp, ascii_file):
+    """Upload converted ASCII formatted user data with an open paramiko SFTP
+    client, e.g. sftp_client of a connection from connect_sftp."""
+    remote_path = os.path.basename(ascii_file)
+    local_stat = os.stat(ascii_file)
 
-    # Copy file to FTP server, preserve modification time.
-    srv.put(ascii_file, preserve_mtime=True)
+    # Copy file to FTP server. Pipelined writes don't wait on the server to
+    # acknowledge each block before sending the next.
+    with open(ascii_file, "rb") as local_file, sftp.open(remote_path, "wb") as remote_file:
+        remote_file.set_pipelined(True)
+        copyfileobj(local_file, remote_file, SFTP_BLOCK_SIZE)
 
-    # Closes the connection
-    srv.close()
+    # Confirm full file arrived and preserve modification time.
+    if sftp.stat(remote_path).st_size != local_stat.st_size:
+        raise IOError("Size mismatch uploading " + remote_path)
+    sftp.utime(remote_path, (local_stat.st_atime, local_stat.st_mtime))
 
 
 def main():
@@ -189,72 +332,82 @@ def main():
             os.mkdir(ASCII_DIR)
         except (IOError, OSError):
             print(PERM_ERROR)
-            exit(1)
+            sys.exit(1)
 
     # Generate timestamped file to append user ASCII.
     ascii_path = os.path.join(ASCII_DIR, "LDUSER-" + TIMESTAMP + ".txt")
+    # Binary mode so newlines aren't translated on Windows.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
     try:
-        ascii_file = open(ascii_path, "w+", newline="\n")
+        ascii_fd = os.open(ascii_path, flags, 0o666)
     except (IOError, OSError):
         print(PERM_ERROR)
-        exit(1)
+        sys.exit(1)
 
-    # Loop through CSV to append user values to LDUSER form.
+    # Loop through CSV to append user values to LDUSER form. Records are
+    # buffered and written to the file in one call once the CSV is read.
+    buf = bytearray()
+    emit_record = compile_emitter(encode_template(RECORD_TEMPLATE))
     with open(CSV_PATH) as csv_file:
-        reader = csv.DictReader(csv_file)
+        reader = csv.reader(csv_file)
+        # An empty CSV has no header. Fall back to the expected column order
+        # so that no rows are read.
+        header = next(reader, CSV_COLUMNS)
+        # Later duplicate column names win, same as csv.DictReader.
+        positions = dict((name, i) for i, name in enumerate(header))
+        get_columns = operator.itemgetter(*[positions[name] for name in CSV_COLUMNS])
+        # Local names for functions and globals used on every row.
+        _transform_zip = transform_zip
+        _transform_phone = transform_phone
+        _get_grad_year = get_grad_year
+        id_prefix = ID_PREFIX
+        expire_day = EXPIRE_DAY
         for row in reader:
+            # Skip blank lines like csv.DictReader does.
+            if not row:
+                continue
+            (student_id, first_name, last_name, birthdate, grade, year, street,
+             city, state, zip_number, email, phone) = get_columns(row)
+
             # Get modified values as needed.
-            zip_code = transform_zip(row["zip"])
-            phone_number = transform_phone(row["phone_number"])
-            grad_year = get_grad_year(row["grad_year"], row["grade"])
-            user_id = config.get("data", "id_prefix") + row["student_id"]
-
-            ascii_file.write("*** DOCUMENT BOUNDARY ***\nFORM=LDUSER\n")
-            ascii_record = dict([
-                ("USER_ID", user_id),
-                ("USER_ROUTING_FLAG", config.get("data", "USER_ROUTING_FLAG")),
-                ("USER_FIRST_NAME", row["first_name"]),
-                ("USER_LAST_NAME", row["last_name"]),
-                ("USER_NAME_DSP_PREF", config.get("data", "USER_NAME_DSP_PREF")),
-                ("USER_BIRTH_DATE", row["birthdate"]),
-                ("USER_LIBRARY", config.get("data", "USER_LIBRARY")),
-                ("USER_PROFILE", config.get("data", "USER_PROFILE")),
-                ("USER_PIN", user_id[-4:]),
-                ("USER_ACCESS", config.get("data", "USER_ACCESS")),
-                ("USER_ENVIRONMENT", config.get("data", "USER_ENVIRONMENT")),
-                ("USER_CATEGORY1", config.get("data", "USER_CATEGORY1")),
-                ("USER_CATEGORY11", config.get("data", "USER_CATEGORY11")),
-                ("USER_CATEGORY12", grad_year),
-                ("USER_PRIV_EXPIRES", grad_year + config.get("data", "expire_day")),
-                ("USER_STATUS", config.get("data", "USER_STATUS")),
-                ("USER_MAILINGADDR", "1"),
-                ("USER_ADDR1_BEGIN", ""),
-                ("STREET", row["street"]),
-                ("CITY/STATE", row["city"] + " " + row["state"]),
-                ("ZIP", zip_code),
-                ("PHONE", phone_number),
-                ("EMAIL", row["email"]),
-                ("USER_ADDR1_END", ""),
-                ("USER_XINFO_BEGIN", ""),
-                ("NOTIFY_VIA", config.get("data", "NOTIFY_VIA")),
-                ("USER_XINFO_END", ""),
-                ("USER_CHG_HIST_RULE", config.get("data", "USER_CHG_HIST_RULE"))
-            ])
-
-            for field, value in list(ascii_record.items()):
-                write_value(ascii_file, field, value)
-            ascii_file.write("\n")
+            zip_code = _transform_zip(zip_number)
+            phone_number = _transform_phone(phone)
+            grad_year = _get_grad_year(year, grade)
+            user_id = id_prefix + student_id
+
+            emit_record(buf, (
+                user_id,
+                first_name,
+                last_name,
+                birthdate,
+                user_id[-4:],
+                grad_year,
+                grad_year + expire_day,
+                street,
+                city + " " + state,
+                zip_code,
+                phone_number,
+                email,
+            ))
+
+    try:
+        write_buffer(ascii_fd, buf)
+    except (IOError, OSError):
+        print(PERM_ERROR)
+        sys.exit(1)
 
     # Close file before copying to avoid I/O buffer issues.
-    ascii_file.close()
+    os.close(ascii_fd)
     # Copy result to standard file name in main folder.
     copy_report(ascii_path)
 
     # Only keep latest 10 reports.
     r = report_dates(ASCII_DIR)
-    sorted_r = sorted(list(r.items()), reverse=True, key=operator.itemgetter(1))
-    for x in sorted_r[10:]:
-        p = os.path.join(ASCII_DIR, x[0])
+    keep = set(name for name, _ in heapq.nlargest(10, r.items(), key=operator.itemgetter(1)))
+    for name in r:
+        if name in keep:
+            continue
+        p = ASCII_DIR_SEP + name
         try:
             os.remove(p)
         except (IOError, OSError):
@@ -262,7 +415,9 @@ def main():
 
     # Copy resulting file to configured SFTP server if flag set.
     if args.sftp is True:
-        upload_ftp_file(ASCII_DEST)
+        srv = connect_sftp()
+        upload_ftp_file(srv.sftp_client, ASCII_DEST)
+        srv.close()
 
 
 if __name__ == "__main__":